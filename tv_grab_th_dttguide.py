@@ -7,18 +7,67 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 import argparse
+import base64
+import functools
+import io
+import os
 import sys
-import xml.etree.ElementTree as ET
 
-from datetime import datetime, timedelta, timezone
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
 from enum import Enum
 from typing import Optional, TextIO
+from xml.sax.saxutils import escape
 
 import requests
+from requests.adapters import HTTPAdapter
+
+# orjson decodes the many-MB program data responses several times faster
+# than the stdlib. Both expose loads() accepting bytes.
+try:
+    import orjson as _json
+except ImportError:
+    import json as _json
 
 TZ_THAI = timezone(timedelta(hours=7))
 
 
+# Cached because the same (date, time slot) pair repeats across channels,
+# and the set of distinct pairs is bounded (days in the feed x time slots).
+@functools.lru_cache(maxsize=None)
+def _parse_pg_datetime(pgDate: str, pgBeginTime: str) -> datetime:
+    # Equivalent to strptime(f"{pgDate} {pgBeginTime}", "%d-%m-%y %H:%M:%S"),
+    # but rearranging the fixed DD-MM-YY layout into ISO 8601 lets the
+    # C-level fromisoformat parser do all the work, offset included.
+    return datetime.fromisoformat(
+        f"20{pgDate[6:8]}-{pgDate[3:5]}-{pgDate[0:2]}T{pgBeginTime}+07:00"
+    )
+
+
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+# One entry per day in the feed; lets filters compare dates without
+# parsing the full datetime.
+@functools.lru_cache(maxsize=None)
+def _pg_date_ordinal(pgDate: str) -> int:
+    return date(2000 + int(pgDate[6:8]), int(pgDate[3:5]), int(pgDate[0:2])).toordinal()
+
+
+@functools.lru_cache(maxsize=None)
+def _pg_epoch(pgDate: str, pgBeginTime: str) -> int:
+    # Seconds since the Unix epoch as a plain int, so the filter compares
+    # integers instead of datetime objects. TZ_THAI has no DST, making
+    # this straight arithmetic.
+    return (
+        (_pg_date_ordinal(pgDate) - _EPOCH_ORDINAL) * 86400
+        + int(pgBeginTime[0:2]) * 3600
+        + int(pgBeginTime[3:5]) * 60
+        + int(pgBeginTime[6:8])
+        - 7 * 3600
+    )
+
+
 class DTTGuide:
     """
     Internal API for https://dttguide.nbtc.go.th/dttguide/
@@ -36,10 +85,20 @@ class DTTGuide:
 
     def __init__(self):
         self.req_session.headers.update(
-            {"content-type": "application/json; charset=utf-8"}
+            {
+                "content-type": "application/json; charset=utf-8",
+                "accept": "application/json",
+                # Program data responses are large and highly compressible;
+                # urllib3 decompresses transparently.
+                "accept-encoding": "gzip, deflate",
+            }
+        )
+        # One pooled connection per concurrent fetch in fetch_filter_convert().
+        self.req_session.mount(
+            "https://", HTTPAdapter(pool_connections=5, pool_maxsize=5)
         )
 
-    def getJson(self, action: str, channel_type: Optional[ChannelType] = None) -> dict:
+    def getRaw(self, action: str, channel_type: Optional[ChannelType] = None) -> bytes:
         url = f"{DTTGuide.BASE_URL}/{action}"
         if channel_type is not None:
             data = {"channelType": f"{channel_type.value}"}
@@ -47,7 +106,10 @@ class DTTGuide:
             data = None
 
         res = self.req_session.post(url, json=data)
-        return res.json()
+        return res.content
+
+    def getJson(self, action: str, channel_type: Optional[ChannelType] = None) -> dict:
+        return _json.loads(self.getRaw(action, channel_type))
 
     def getProgramDataWeb(self, channel_type: ChannelType) -> list[dict[str, str]]:
         res_json = self.getJson("getProgramDataWeb", channel_type)
@@ -62,181 +124,312 @@ class DTTGuide:
         return res_json["channelLogoMediaImage"]
 
 
-def channels_from_chnames_and_chlogos(
+def _format_xmltv_datetime(dt: datetime) -> str:
+    # Same output as dt.strftime("%Y%m%d%H%M%S %z"), minus the format
+    # machinery. The offset is constant because everything is in TZ_THAI.
+    return (
+        f"{dt.year:04d}{dt.month:02d}{dt.day:02d}"
+        f"{dt.hour:02d}{dt.minute:02d}{dt.second:02d} +0700"
+    )
+
+
+def write_channels_xml(
+    outfile: TextIO,
     chnames: list[dict[str, str]],
     chlogos: list[dict[str, str]],
     dispname_exceptions: dict[str, str],
-) -> list[ET.Element]:
-    ret: list[ET.Element] = []
+    logo_dir: Optional[str] = None,
+) -> None:
+    logos_by_no = {logo["channelNo"]: logo for logo in chlogos}
 
     for ch in chnames:
-        e_channel = ET.Element(
-            "channel",
-            {
-                # XXX: please suggest a better way for id.
-                "id": f"{ch["channelNo"]}.dttguide.nbtc.go.th",
-            },
-        )
+        # XXX: please suggest a better way for id.
+        outfile.write(f'<channel id="{ch["channelNo"]}.dttguide.nbtc.go.th">')
 
         try:
-            ET.SubElement(e_channel, "display-name", {"lang": "th"}).text = (
-                dispname_exceptions[ch["channelNo"]]
+            outfile.write(
+                '<display-name lang="th">'
+                f"{escape(dispname_exceptions[ch['channelNo']])}</display-name>"
             )
         except KeyError:
             pass
 
-        ET.SubElement(e_channel, "display-name", {"lang": "th"}).text = ch["stnName"]
+        outfile.write(
+            f'<display-name lang="th">{escape(ch["stnName"])}</display-name>'
+        )
 
         if ch["stnNickname"] != ch["stnName"]:
-            ET.SubElement(e_channel, "display-name", {"lang": "th"}).text = ch[
-                "stnNickname"
-            ]
+            outfile.write(
+                f'<display-name lang="th">{escape(ch["stnNickname"])}</display-name>'
+            )
 
-        for logo in chlogos:
-            if logo["channelNo"] == ch["channelNo"]:
-                ET.SubElement(
-                    e_channel,
-                    "icon",
-                    {
-                        # XXX: I have no idea if data URL is supported.
-                        "src": f"data:image/png;base64,{logo["channelLogoImage"]}"
-                    },
-                )
+        logo = logos_by_no.get(ch["channelNo"])
+        if logo is not None:
+            if logo_dir is not None:
+                with open(
+                    os.path.join(logo_dir, f"{ch['channelNo']}.png"), "wb"
+                ) as logo_file:
+                    logo_file.write(base64.b64decode(logo["channelLogoImage"]))
 
-                break
+                # Relative to the output file, which sits next to logo_dir.
+                src = f"{os.path.basename(logo_dir)}/{ch['channelNo']}.png"
+            else:
+                # XXX: I have no idea if data URL is supported.
+                src = f"data:image/png;base64,{logo['channelLogoImage']}"
 
-        ret.append(e_channel)
+            # channelNo is digits and base64 has no XML specials, so src
+            # needs no escaping.
+            outfile.write(f'<icon src="{src}"/>')
 
-    return ret
+        outfile.write("</channel>")
 
 
 def parse_duration(pgDuration: str):
-    hours, minutes, seconds = pgDuration.split(":")
-    return timedelta(hours=float(hours), minutes=float(minutes), seconds=float(seconds))
+    if len(pgDuration) > 8:
+        # Just in case sub-second precision ever shows up.
+        hours, minutes, seconds = pgDuration.split(":")
+        return timedelta(
+            hours=float(hours), minutes=float(minutes), seconds=float(seconds)
+        )
 
+    # Always "HH:MM:SS" in practice; slicing avoids the split() list and
+    # float parsing.
+    return timedelta(
+        seconds=int(pgDuration[0:2]) * 3600
+        + int(pgDuration[3:5]) * 60
+        + int(pgDuration[6:8])
+    )
 
-def programme_from_programdata(program_data: list[dict[str, str]]) -> list[ET.Element]:
-    ret: list[ET.Element] = []
 
-    for program in program_data:
-        start = datetime.strptime(
-            f"{program['pgDate']} {program['pgBeginTime']}", "%d-%m-%y %H:%M:%S"
-        ).replace(tzinfo=TZ_THAI)
-        stop = start + parse_duration(program["pgDuration"])
+def programme_xml_from_program(
+    program: dict[str, str], channel_id: str, start: datetime
+) -> str:
+    stop = start + parse_duration(program["pgDuration"])
 
-        e_programme = ET.Element(
-            "programme",
-            {
-                # Match channel entry above.
-                "channel": f"{program["channelNo"]}.dttguide.nbtc.go.th",
-                "start": start.strftime("%Y%m%d%H%M%S %z"),
-                "stop": stop.strftime("%Y%m%d%H%M%S %z"),
-            },
-        )
+    parts = [
+        # Match channel entry above.
+        f'<programme channel="{channel_id}"'
+        f' start="{_format_xmltv_datetime(start)}"'
+        f' stop="{_format_xmltv_datetime(stop)}">',
+        f'<title lang="th">{escape(program["pgTitle"])}</title>',
+    ]
 
-        ET.SubElement(e_programme, "title", {"lang": "th"}).text = program["pgTitle"]
-        if program["pgDesc"] is not None:
-            ET.SubElement(e_programme, "desc", {"lang": "th"}).text = program["pgDesc"]
+    if program["pgDesc"] is not None:
+        parts.append(f'<desc lang="th">{escape(program["pgDesc"])}</desc>')
 
-        # TODO: a way to express audioDescFlag, multiLangFlag in XMLTV.
-        # TODO: what is subTitleFlag exactly?
+    # TODO: a way to express audioDescFlag, multiLangFlag in XMLTV.
+    # TODO: what is subTitleFlag exactly?
 
-        if program["closeCaptFlag"] == "Y":
-            ET.SubElement(e_programme, "subtitles", {"type": "teletext"})
-        if program["signLangFlag"] == "Y":
-            ET.SubElement(e_programme, "subtitles", {"type": "deaf-signed"})
+    if program["closeCaptFlag"] == "Y":
+        parts.append('<subtitles type="teletext"/>')
+    if program["signLangFlag"] == "Y":
+        parts.append('<subtitles type="deaf-signed"/>')
 
-        ret.append(e_programme)
+    parts.append("</programme>")
+    return "".join(parts)
 
-    return ret
 
+_DISPNAME_EXCEPTIONS = {
+    # No one calls ThaiPBS "องค์การกระจายเสียงและแพร่ภาพสาธารณะแห่งประเทศไทย"
+    "03": "ThaiPBS",
+    "27": "ช่อง 8",
+}
 
-# Return whether data covers [earliest_start, latest_start_exclusive)
-# TODO: split this function into 4 (fetch(?), filter, convert, is_cover_days)
-def fetch_filter_convert(
-    outfile: TextIO,
+
+def _convert_channel_type(
+    raw_chnames: bytes,
+    raw_chlogos: bytes,
+    raw_program_data: bytes,
     earliest_start: Optional[datetime],
     latest_start_exclusive: Optional[datetime],
-) -> bool:
-    dtt_guide = DTTGuide()
+    logo_dir: Optional[str] = None,
+) -> tuple[str, str, bool, bool]:
+    """
+    Decode, filter and convert one channel type's worth of raw API
+    responses. Takes bytes and returns strings so that it can run in a
+    worker process, letting the NATIONAL and LOCAL halves convert in
+    parallel.
 
-    chnames = dtt_guide.getChannelNameWeb()
-    chlogos = dtt_guide.getChannelLogoMediaWeb(
-        DTTGuide.ChannelType.NATIONAL
-    ) + dtt_guide.getChannelLogoMediaWeb(DTTGuide.ChannelType.LOCAL)
-    program_data = dtt_guide.getProgramDataWeb(
-        DTTGuide.ChannelType.NATIONAL
-    ) + dtt_guide.getProgramDataWeb(DTTGuide.ChannelType.LOCAL)
+    Returns (channels XML, programmes XML, covers_earliest_start,
+    covers_latest_start_exclusive).
+    """
+    chnames = _json.loads(raw_chnames)["results"]
+    chlogos = _json.loads(raw_chlogos)["channelLogoMediaImage"]
+    program_data = _json.loads(raw_program_data)["results"]
+
+    # A few dozen distinct channelNo strings appear in nearly every row
+    # and get hashed over and over below; interning them lets dict/set
+    # lookups compare by identity.
+    for row in chnames:
+        row["channelNo"] = sys.intern(row["channelNo"])
+    for row in chlogos:
+        row["channelNo"] = sys.intern(row["channelNo"])
+    for row in program_data:
+        row["channelNo"] = sys.intern(row["channelNo"])
+
+    # Reduce the window bounds to integers up front; the filter then only
+    # compares ints, and datetime objects are built just for the rows
+    # that survive it.
+    earliest_ord = earliest_ts = None
+    if earliest_start is not None:
+        earliest_thai = earliest_start.astimezone(TZ_THAI)
+        earliest_ord = earliest_thai.date().toordinal()
+        earliest_ts = int(earliest_thai.timestamp())
+
+    latest_ord = latest_ts = None
+    if latest_start_exclusive is not None:
+        latest_thai = latest_start_exclusive.astimezone(TZ_THAI)
+        latest_ord = latest_thai.date().toordinal()
+        latest_ts = int(latest_thai.timestamp())
 
     def whithin_start_dates(program):
-        start = datetime.strptime(
-            f"{program['pgDate']} {program['pgBeginTime']}", "%d-%m-%y %H:%M:%S"
-        ).replace(tzinfo=TZ_THAI)
-
-        if earliest_start is not None and start < earliest_start:
-            return False
-
-        if latest_start_exclusive is not None and start >= latest_start_exclusive:
-            return False
+        # Rows outside the window almost always differ in date, not time
+        # of day. Compare the (cached) date ordinal first, and look at
+        # epoch seconds only for rows landing on a boundary date.
+        pg_ord = _pg_date_ordinal(program["pgDate"])
+
+        if earliest_ts is not None:
+            if pg_ord < earliest_ord:
+                return False
+            if pg_ord == earliest_ord and (
+                _pg_epoch(program["pgDate"], program["pgBeginTime"]) < earliest_ts
+            ):
+                return False
+
+        if latest_ts is not None:
+            if pg_ord > latest_ord:
+                return False
+            if pg_ord == latest_ord and (
+                _pg_epoch(program["pgDate"], program["pgBeginTime"]) >= latest_ts
+            ):
+                return False
 
         return True
 
-    program_data = list(filter(whithin_start_dates, program_data))
+    # A single pass over the raw rows replaces the previous four (filter,
+    # start-time parse, channel collection, conversion, coverage check).
+    # Programmes are serialized right away; their text has to be buffered
+    # regardless, because XMLTV wants all <channel> entries first and
+    # those depend on which channels have programs.
+    channel_ids: dict[str, str] = {}
+    programme_xml: list[str] = []
+    covers_earliest_start = False
+    covers_latest_start_exclusive = False
+    check_coverage = earliest_start is not None and latest_start_exclusive is not None
 
-    channels_with_program: set[str] = set()
     for program in program_data:
-        channels_with_program.add(program["channelNo"])
-
-    chnames = list(filter(lambda ch: ch["channelNo"] in channels_with_program, chnames))
-
-    e_tv = ET.Element(
-        "tv",
-        {
-            "source-info-name": "DTT Guide",
-            "source-info-url": "https://dttguide.nbtc.go.th/dttguide/",
-            "generator-info-name": "tv_grab_th_dttguide",
-            "generator-info-url": "https://github.com/peat-psuwit/tv_grab_th_dttguide",
-        },
-    )
+        if not whithin_start_dates(program):
+            continue
 
-    e_tv.extend(
-        channels_from_chnames_and_chlogos(
-            chnames,
-            chlogos,
-            {
-                # No one calls ThaiPBS "องค์การกระจายเสียงและแพร่ภาพสาธารณะแห่งประเทศไทย"
-                "03": "ThaiPBS",
-                "27": "ช่อง 8",
-            },
-        )
+        start = _parse_pg_datetime(program["pgDate"], program["pgBeginTime"])
+
+        channel_no = program["channelNo"]
+        channel_id = channel_ids.get(channel_no)
+        if channel_id is None:
+            channel_id = channel_ids[channel_no] = f"{channel_no}.dttguide.nbtc.go.th"
+
+        programme_xml.append(programme_xml_from_program(program, channel_id, start))
+
+        if check_coverage:
+            if start - earliest_start < timedelta(hours=24):
+                covers_earliest_start = True
+            if latest_start_exclusive - start < timedelta(hours=24):
+                covers_latest_start_exclusive = True
+
+    chnames = [ch for ch in chnames if ch["channelNo"] in channel_ids]
+
+    channels_out = io.StringIO()
+    write_channels_xml(channels_out, chnames, chlogos, _DISPNAME_EXCEPTIONS, logo_dir)
+
+    return (
+        channels_out.getvalue(),
+        "".join(programme_xml),
+        covers_earliest_start,
+        covers_latest_start_exclusive,
     )
-    e_tv.extend(programme_from_programdata(program_data))
 
-    tree = ET.ElementTree(e_tv)
-    tree.write(outfile, encoding="unicode", xml_declaration=True)
 
-    # Determine whether program_data covers [earliest_start, latest_start_exclusive)
+# Return whether data covers [earliest_start, latest_start_exclusive)
+def fetch_filter_convert(
+    outfile: TextIO,
+    earliest_start: Optional[datetime],
+    latest_start_exclusive: Optional[datetime],
+    logo_dir: Optional[str] = None,
+) -> bool:
+    dtt_guide = DTTGuide()
 
-    if earliest_start is None or latest_start_exclusive is None:
-        return True
+    # The 5 API calls are independent, so issue them concurrently and pay
+    # roughly one round-trip instead of five. requests.Session is
+    # thread-safe for separate requests. The responses stay as raw bytes
+    # here; decoding happens in the worker processes below.
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        f_chnames = executor.submit(dtt_guide.getRaw, "getChannelNameWeb")
+        f_chlogos_national = executor.submit(
+            dtt_guide.getRaw, "getChannelLogoMediaWeb", DTTGuide.ChannelType.NATIONAL
+        )
+        f_chlogos_local = executor.submit(
+            dtt_guide.getRaw, "getChannelLogoMediaWeb", DTTGuide.ChannelType.LOCAL
+        )
+        f_program_data_national = executor.submit(
+            dtt_guide.getRaw, "getProgramDataWeb", DTTGuide.ChannelType.NATIONAL
+        )
+        f_program_data_local = executor.submit(
+            dtt_guide.getRaw, "getProgramDataWeb", DTTGuide.ChannelType.LOCAL
+        )
 
-    covers_earliest_start = False
-    covers_latest_start_exclusive = False
-    for program in program_data:
-        start = datetime.strptime(
-            f"{program['pgDate']} {program['pgBeginTime']}", "%d-%m-%y %H:%M:%S"
-        ).replace(tzinfo=TZ_THAI)
+        raw_chnames = f_chnames.result()
+        raw_chlogos = (f_chlogos_national.result(), f_chlogos_local.result())
+        raw_program_data = (
+            f_program_data_national.result(),
+            f_program_data_local.result(),
+        )
 
-        if start - earliest_start < timedelta(hours=24):
-            covers_earliest_start = True
+    # The CPU-bound part (JSON decode, filtering, XML building) splits
+    # naturally between NATIONAL and LOCAL, so run the halves in worker
+    # processes, sidestepping the GIL. The channel name response is small
+    # and goes to both workers; each keeps only the channels that have
+    # programs in its half.
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        futures = [
+            executor.submit(
+                _convert_channel_type,
+                raw_chnames,
+                raw_chlogos[i],
+                raw_program_data[i],
+                earliest_start,
+                latest_start_exclusive,
+                logo_dir,
+            )
+            for i in range(2)
+        ]
+        results = [f.result() for f in futures]
+
+    # Write the <tv> envelope by hand and splice in the workers' output.
+    # (All attribute values here are fixed strings, so no escaping needed.)
+    outfile.write("<?xml version='1.0' encoding='utf-8'?>\n")
+    outfile.write(
+        '<tv source-info-name="DTT Guide"'
+        ' source-info-url="https://dttguide.nbtc.go.th/dttguide/"'
+        ' generator-info-name="tv_grab_th_dttguide"'
+        ' generator-info-url="https://github.com/peat-psuwit/tv_grab_th_dttguide">'
+    )
 
-        if latest_start_exclusive - start < timedelta(hours=24):
-            covers_latest_start_exclusive = True
+    # All <channel> entries must come before any <programme>.
+    for channels_xml, _, _, _ in results:
+        outfile.write(channels_xml)
+    for _, programme_xml, _, _ in results:
+        outfile.write(programme_xml)
 
-        if covers_earliest_start and covers_latest_start_exclusive:
-            return True
+    outfile.write("</tv>")
 
-    return False
+    # Whether program_data covers [earliest_start, latest_start_exclusive)
+    if earliest_start is None or latest_start_exclusive is None:
+        return True
+
+    # A program in either half can satisfy either end of the window.
+    return any(covers for _, _, covers, _ in results) and any(
+        covers for _, _, _, covers in results
+    )
 
 
 def main() -> int:
@@ -280,8 +473,13 @@ def main() -> int:
         return 0
 
     outfile = sys.stdout
+    logo_dir: Optional[str] = None
     if args.output is not None:
         outfile = open(args.output, "w")
+        # With a real output file, logos can be written next to it instead
+        # of being inlined as (much larger) base64 data URLs.
+        logo_dir = args.output + ".logos"
+        os.makedirs(logo_dir, exist_ok=True)
 
     earliest_start: datetime
     latest_start_exclusive: Optional[datetime] = None
@@ -293,7 +491,9 @@ def main() -> int:
     if args.days is not None:
         latest_start_exclusive = earliest_start + timedelta(days=args.days)
 
-    covers_days = fetch_filter_convert(outfile, earliest_start, latest_start_exclusive)
+    covers_days = fetch_filter_convert(
+        outfile, earliest_start, latest_start_exclusive, logo_dir
+    )
 
     if covers_days:
         return 0